@@ -0,0 +1,48 @@
+# backfill_lookup_keys.py
+# One-off script that writes the 'lookupKey' field on every existing document
+# in the Firestore 'patients' collection so verification can query on it.
+#
+# Usage: python backfill_lookup_keys.py
+
+import logging
+
+from main import get_db, _lookup_key
+
+# Firestore allows at most 500 writes per batch.
+BATCH_SIZE = 500
+
+def backfill():
+    """
+    Computes and stores the lookup key for every patient document.
+    """
+    db = get_db()
+    batch = db.batch()
+    pending = 0
+    updated = 0
+
+    for doc in db.collection('patients').stream():
+        data = doc.to_dict()
+        key = _lookup_key(
+            data.get('policyNumber', ''),
+            data.get('insuranceProvider', ''),
+            data.get('dateOfBirth', '')
+        )
+        if data.get('lookupKey') == key:
+            continue
+
+        batch.update(doc.reference, {'lookupKey': key})
+        pending += 1
+        updated += 1
+
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+    logging.info(f"Backfilled lookupKey on {updated} patient documents.")
+
+if __name__ == '__main__':
+    backfill()
@@ -0,0 +1,31 @@
+# gunicorn.conf.py
+# Gunicorn settings for serving the webhook in production.
+# Each request spends most of its time waiting on Firestore, so a few
+# processes with many threads each give the best throughput.
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# Keep idle connections open longer than the load balancer does (60s on
+# Google Cloud) so it never reuses a connection we have already closed.
+keepalive = 65
+# Cloud Run enforces the request timeout itself. Every Firestore call in the app,
+# including the post_fork warm-up and its credential refresh, carries its own
+# FIRESTORE_TIMEOUT deadline.
+timeout = 0
+
+def post_fork(server, worker):
+    """
+    Opens the Firestore channel and completes the auth handshake in each worker
+    before it starts accepting requests, so the first user request doesn't pay for it.
+    """
+    from main import FIRESTORE_TIMEOUT, get_db, start_policy_bloom_refresher
+    try:
+        get_db().collection('patients').limit(1).select([]).get(timeout=FIRESTORE_TIMEOUT)
+        server.log.info(f"Worker {worker.pid}: Firestore client warmed.")
+    except Exception as e:
+        server.log.warning(f"Worker {worker.pid}: Firestore warm-up failed: {e}")
+    start_policy_bloom_refresher()
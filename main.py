@@ -3,35 +3,341 @@
 # connects to a Firestore database for patient data verification.
 
 import os
-import json
+import hashlib
+import hmac
+import io
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import date
+from functools import lru_cache, partial
+from typing import Optional, Union
 import firebase_admin
+import google.auth.transport.requests
+import msgspec
+import orjson
+import redis
+from cachetools import TTLCache
+from pybloom_live import ScalableBloomFilter
 from firebase_admin import credentials, firestore
-from flask import Flask, request, jsonify
+from flask import Flask, request, abort
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Firestore talks to the backend through grpcio's C-core extension; refuse to
+# start without it rather than run slowly or fail on the first query.
+try:
+    from grpc._cython import cygrpc  # noqa: F401
+except ImportError as e:
+    raise RuntimeError("grpcio's C extension (grpc._cython.cygrpc) is not available; install a binary grpcio wheel.") from e
+
+# Configure logging. Set LOG_LEVEL=DEBUG to log full request/response payloads.
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
 # --- Firestore Connection Setup ---
-try:
-    # On Cloud Run, credentials are automatically provided by the environment.
-    cred = credentials.ApplicationDefault()
-    firebase_admin.initialize_app(cred)
-    logging.info("Firestore connected using Cloud Run environment credentials.")
-except ValueError:
-    # If running locally, you'll need a service account JSON file.
-    # Set the 'GOOGLE_APPLICATION_CREDENTIALS' environment variable to its file path.
+# Firebase and the Firestore client are created on first use rather than at
+# import time, so paths that never touch the database don't pay for them.
+# Under Gunicorn, post_fork in gunicorn.conf.py warms the client in each worker.
+_init_lock = threading.Lock()
+
+# Deadline in seconds for each verification query. Every request holds a worker
+# thread while it waits on Firestore, so a stalled RPC must not hold it forever.
+FIRESTORE_TIMEOUT = float(os.environ.get('FIRESTORE_TIMEOUT', 5))
+
+def _init_firebase():
+    """Initializes the default Firebase app unless it already exists."""
+    if firebase_admin._apps:
+        return
     try:
-        cred = credentials.Certificate(os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'))
-        firebase_admin.initialize_app(cred)
-        logging.info("Firestore connected using GOOGLE_APPLICATION_CREDENTIALS.")
+        # Application Default Credentials cover Cloud Run, GKE and GCE, as well as
+        # local development via 'gcloud auth application-default login' or a
+        # key file named by the GOOGLE_APPLICATION_CREDENTIALS environment variable.
+        firebase_admin.initialize_app(credentials.ApplicationDefault())
+        logger.info("Firestore connected using Application Default Credentials.")
     except Exception as e:
-        logging.error(f"Error initializing Firebase: {e}")
+        logger.error("Error initializing Firebase: %s", e)
         # To prevent the app from crashing, we'll continue, but database calls will fail.
 
-db = firestore.client()
+@lru_cache(maxsize=1)
+def get_db():
+    """
+    Returns the process-wide Firestore client, initializing Firebase if needed.
+    The client holds a single pooled gRPC channel for the life of the process,
+    so always go through this accessor rather than creating clients per request.
+    """
+    with _init_lock:
+        _init_firebase()
+        _warm_credentials()
+    return firestore.client()
+
+def _warm_credentials():
+    """
+    Fetches the OAuth token up front so the gRPC auth plugin finds a valid
+    cached token instead of refreshing it during the first query. The token
+    request gets the FIRESTORE_TIMEOUT deadline, since it runs under _init_lock.
+    """
+    try:
+        creds = firebase_admin.get_app().credential.get_credential()
+        if not creds.valid:
+            creds.refresh(partial(google.auth.transport.requests.Request(), timeout=FIRESTORE_TIMEOUT))
+    except Exception as e:
+        logger.warning("Could not pre-fetch Firebase credentials: %s", e)
+
+# --- Verification Cache ---
+# Identical (policy, provider, dob) lookups are answered from memory for a few
+# minutes so retries and repeated turns in a session skip the Firestore round-trip.
+# Only the match result is cached; the response text is built by the caller.
+# Keep VERIFY_CACHE_TTL shorter than the SLA for patient-record updates, and
+# call POST /cache/invalidate when a patient record changes.
+VERIFY_CACHE_TTL = 300
+_verify_cache = TTLCache(maxsize=10_000, ttl=VERIFY_CACHE_TTL)
+_verify_cache_lock = threading.Lock()
+# Lookups currently waiting on Firestore, keyed like the cache. Concurrent
+# requests for the same key (e.g. Dialogflow retries) share one query.
+_verify_inflight = {}
+
+# --- Shared Cache (Redis / Memorystore) ---
+# When REDIS_URL is set, verification results are also shared across workers
+# and instances in Redis. Redis failures fall back to querying Firestore.
+REDIS_URL = os.environ.get('REDIS_URL')
+
+@lru_cache(maxsize=1)
+def get_redis():
+    """Returns the process-wide Redis client, or None if REDIS_URL is not set."""
+    if not REDIS_URL:
+        return None
+    return redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+def _redis_key(policy_number, provider, dob):
+    """Returns the Redis key holding the verification result for these details."""
+    return "verify:" + _lookup_key(policy_number, provider, dob)
+
+# --- Known Policy Numbers ---
+# A Bloom filter of every policyNumber in Firestore lets lookups for unknown
+# policies skip Firestore. It is shared through Redis (so it needs REDIS_URL):
+# one worker in the deployment rebuilds it every POLICY_BLOOM_REFRESH_SECONDS
+# (0 disables it), and every worker loads the latest build when it polls.
+# Each rebuild reads every patient document, so keep the interval long.
+#
+# POST /cache/invalidate records the policy number in a Redis sorted set, and
+# a policy missing from the filter is only rejected if it is not in that set,
+# so patients added since the last rebuild are still found. Records written
+# without calling /cache/invalidate are rejected until the next rebuild. A
+# filter older than POLICY_BLOOM_MAX_AGE_SECONDS (e.g. because rebuilds keep
+# failing) rejects nothing.
+POLICY_BLOOM_REFRESH_SECONDS = int(os.environ.get('POLICY_BLOOM_REFRESH_SECONDS', 3600))
+POLICY_BLOOM_MAX_AGE_SECONDS = int(os.environ.get('POLICY_BLOOM_MAX_AGE_SECONDS', 7200))
+_POLICY_BLOOM_POLL_SECONDS = 15
+POLICY_BLOOM_BUILD_TIMEOUT = int(os.environ.get('POLICY_BLOOM_BUILD_TIMEOUT', 300))
+# The rebuild lock outlives the longest allowed scan.
+_POLICY_BLOOM_LOCK_SECONDS = POLICY_BLOOM_BUILD_TIMEOUT + 60
+# After a failed rebuild, no worker retries for 60s, doubling per consecutive
+# failure up to POLICY_BLOOM_REFRESH_SECONDS.
+_POLICY_BLOOM_RETRY_SECONDS = 60
+# Invalidations are kept this long after the start of the build that covers
+# them, to allow for clock skew between instances.
+_POLICY_BLOOM_ADDED_MARGIN = 300
+_BLOOM_KEY = 'policy-bloom'
+_BLOOM_ADDED_KEY = 'policy-bloom:added'
+_BLOOM_LOCK_KEY = 'policy-bloom:lock'
+_BLOOM_BACKOFF_KEY = 'policy-bloom:backoff'
+_BLOOM_FAILURES_KEY = 'policy-bloom:failures'
+
+_PolicyBloom = namedtuple('_PolicyBloom', ['bloom', 'built_at'])
+_policy_bloom = None
+_policy_bloom_thread = None
+_policy_bloom_lock = threading.Lock()
+
+def _policy_bloom_rejects(policy_number):
+    """Returns True if the filter shows the policy number is not on file."""
+    current = _policy_bloom
+    if current is None or time.time() - current.built_at > POLICY_BLOOM_MAX_AGE_SECONDS:
+        return False
+    if policy_number in current.bloom:
+        return False
+    r = get_redis()
+    if r is None:
+        return False
+    try:
+        return r.zscore(_BLOOM_ADDED_KEY, policy_number) is None
+    except redis.RedisError as e:
+        logger.warning("Redis read failed: %s", e)
+        return False
+
+def _build_policy_bloom():
+    """Returns a Bloom filter of all policy numbers in the 'patients' collection."""
+    bloom = ScalableBloomFilter(initial_capacity=10_000, error_rate=0.001)
+    docs = get_db().collection('patients').select(['policyNumber']).stream(timeout=POLICY_BLOOM_BUILD_TIMEOUT)
+    for doc in docs:
+        policy_number = doc.to_dict().get('policyNumber')
+        if policy_number:
+            bloom.add(policy_number)
+    return bloom
+
+def _publish_policy_bloom(r):
+    """
+    Rebuilds the shared filter from Firestore, unless another worker already
+    holds the rebuild lock or a recent rebuild failed.
+    """
+    if r.get(_BLOOM_BACKOFF_KEY) is not None:
+        return
+    token = uuid.uuid4().hex
+    if not r.set(_BLOOM_LOCK_KEY, token, nx=True, ex=_POLICY_BLOOM_LOCK_SECONDS):
+        return
+    try:
+        built_at = time.time()
+        bloom = _build_policy_bloom()
+        data = io.BytesIO()
+        bloom.tofile(data)
+
+        with r.pipeline() as pipe:
+            pipe.hset(_BLOOM_KEY, mapping={'data': data.getvalue(), 'built_at': built_at})
+            # Policies invalidated before this scan started are now in the filter.
+            pipe.zremrangebyscore(_BLOOM_ADDED_KEY, '-inf', built_at - _POLICY_BLOOM_ADDED_MARGIN)
+            pipe.delete(_BLOOM_FAILURES_KEY)
+            pipe.execute()
+        logger.info("Policy number filter rebuilt with %d entries.", len(bloom))
+    except Exception as e:
+        failures = int(r.incr(_BLOOM_FAILURES_KEY))
+        backoff = min(_POLICY_BLOOM_RETRY_SECONDS * 2 ** (failures - 1), POLICY_BLOOM_REFRESH_SECONDS)
+        r.set(_BLOOM_BACKOFF_KEY, '1', ex=backoff)
+        logger.error("Policy number filter rebuild failed (retrying in %ds): %s", backoff, e)
+    finally:
+        _release_policy_bloom_lock(r, token)
+
+def _release_policy_bloom_lock(r, token):
+    """Deletes the rebuild lock only if this worker still holds it."""
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(_BLOOM_LOCK_KEY)
+            if pipe.get(_BLOOM_LOCK_KEY) == token.encode():
+                pipe.multi()
+                pipe.delete(_BLOOM_LOCK_KEY)
+                pipe.execute()
+        except redis.WatchError:
+            pass
+
+def _sync_policy_bloom(r):
+    """Loads the newest shared filter, and rebuilds it if it is missing or due."""
+    global _policy_bloom
+    built_at, = r.hmget(_BLOOM_KEY, ['built_at'])
+    if built_at is None or time.time() - float(built_at) > POLICY_BLOOM_REFRESH_SECONDS:
+        _publish_policy_bloom(r)
+        built_at, = r.hmget(_BLOOM_KEY, ['built_at'])
+        if built_at is None:
+            return
+
+    current = _policy_bloom
+    if current is None or current.built_at != float(built_at):
+        data, built_at = r.hmget(_BLOOM_KEY, ['data', 'built_at'])
+        if data is not None:
+            bloom = ScalableBloomFilter.fromfile(io.BytesIO(data))
+            _policy_bloom = _PolicyBloom(bloom, float(built_at))
+
+def _refresh_policy_bloom():
+    """Keeps this worker's copy of the shared filter current; runs in a daemon thread."""
+    while True:
+        try:
+            _sync_policy_bloom(get_redis())
+        except Exception as e:
+            logger.error("Policy number filter refresh failed: %s", e)
+        time.sleep(_POLICY_BLOOM_POLL_SECONDS)
+
+def start_policy_bloom_refresher():
+    """Starts the background filter refresh once per process, if enabled."""
+    global _policy_bloom_thread
+    if POLICY_BLOOM_REFRESH_SECONDS <= 0:
+        return
+    if get_redis() is None:
+        logger.info("Policy number filter disabled; it requires REDIS_URL.")
+        return
+    if POLICY_BLOOM_REFRESH_SECONDS > POLICY_BLOOM_MAX_AGE_SECONDS:
+        logger.warning(
+            "POLICY_BLOOM_REFRESH_SECONDS (%d) exceeds POLICY_BLOOM_MAX_AGE_SECONDS (%d); "
+            "the policy number filter will be unused for part of each refresh cycle.",
+            POLICY_BLOOM_REFRESH_SECONDS, POLICY_BLOOM_MAX_AGE_SECONDS
+        )
+    with _policy_bloom_lock:
+        if _policy_bloom_thread is None:
+            _policy_bloom_thread = threading.Thread(
+                target=_refresh_policy_bloom, name='policy-bloom-refresh', daemon=True
+            )
+            _policy_bloom_thread.start()
+
+# --- Request Schema ---
+# Only the fields the webhook reads are declared; msgspec skips everything else
+# while decoding, so the request is validated and materialized in one pass.
+# Dialogflow CX sends dates as objects with float components (e.g. 1990.0);
+# Dialogflow ES sends @sys.date as an ISO 8601 string.
+# Parameters are typed loosely because Dialogflow sends null or '' for unfilled
+# parameters and numbers for @sys.number entities; unusable values are treated
+# as missing rather than rejected.
+class Dob(msgspec.Struct):
+    year: Optional[float] = None
+    month: Optional[float] = None
+    day: Optional[float] = None
+
+_Scalar = Union[str, int, float, None]
+
+class Params(msgspec.Struct):
+    policy_number: _Scalar = None
+    insurance_provider_name: _Scalar = None
+    date_of_birth: Union[Dob, str, None] = None
+    # Alternate spellings used by some Dialogflow ES agents.
+    policyNumber: _Scalar = None
+    insurance_provider: _Scalar = None
+
+class SessionInfo(msgspec.Struct):
+    parameters: Params = msgspec.field(default_factory=Params)
+
+class QueryResult(msgspec.Struct):
+    parameters: Params = msgspec.field(default_factory=Params)
+
+class Envelope(msgspec.Struct, rename='camel'):
+    session_info: Optional[SessionInfo] = None
+    query_result: Optional[QueryResult] = None
+
+_envelope_decoder = msgspec.json.Decoder(Envelope)
+
+# --- Parameter Helpers ---
+def _param_text(value):
+    """Returns a parameter value as a string, or '' if it is unset or blank."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if value is None or isinstance(value, str) and not value.strip():
+        return ''
+    return str(value)
+
+def _fmt_dob(o):
+    """
+    Formats a Dialogflow date object into a 'YYYY-MM-DD' string, or returns
+    None if any component is missing or the date is invalid.
+    """
+    if o.year is None or o.month is None or o.day is None:
+        return None
+    try:
+        return date(int(o.year), int(o.month), int(o.day)).isoformat()
+    except (ValueError, OverflowError):
+        return None
+
+def _dob_string(value):
+    """
+    Returns the 'YYYY-MM-DD' string for a Dialogflow date object or an ISO 8601
+    date(time) string such as '1990-01-02T12:00:00+00:00', or None if unset.
+    """
+    if isinstance(value, Dob):
+        return _fmt_dob(value)
+    if value:
+        try:
+            return date.fromisoformat(value[:10]).isoformat()
+        except ValueError:
+            return None
+    return None
 
 # --- Webhook Endpoint ---
 @app.route('/')
@@ -39,54 +345,45 @@ def home():
     """Returns a simple message to confirm the service is running."""
     return "Webhook is running successfully!"
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
+@app.route('/healthz')
+def healthz():
     """
-    Handles POST requests from Dialogflow. It extracts patient information
-    from the request and verifies it against the Firestore 'patients' collection.
+    Startup probe for Cloud Run (see service.yaml). Runs a one-document query so
+    the Firestore channel and auth token are ready before user traffic arrives.
     """
-    logging.info("--- Webhook Request Received ---")
-    req = request.get_json(force=True)
-    
-    # Log the full request JSON for debugging
-    logging.info("Full Request JSON:")
-    logging.info(json.dumps(req, indent=2))
-    logging.info("-----------------------------------")
-
-    # The Dialogflow CX webhook format has a different structure for parameters.
-    # The parameters are nested inside 'sessionInfo'.
-    session_info = req.get('sessionInfo', {})
-    params = session_info.get('parameters', {})
-    
-    # Extract parameters based on your Dialogflow CX configuration.
-    patient_policy_number = params.get('policy_number', '')
-    patient_provider = params.get('insurance_provider_name', '')
-    patient_dob_obj = params.get('date_of_birth', {})
-    
-    # Log the extracted parameters
-    logging.info("Extracted Parameters:")
-    logging.info(f"Policy Number: {patient_policy_number}")
-    logging.info(f"Provider: {patient_provider}")
-    logging.info(f"DOB Object: {patient_dob_obj}")
-    logging.info("-----------------------------------")
-
-    # Check if all required parameters are available.
-    if not all([patient_policy_number, patient_provider, patient_dob_obj]):
-        response_text = "Please provide your policy number, insurance provider, and date of birth to proceed with verification."
-    else:
-        # Correctly format the date of birth object into a 'YYYY-MM-DD' string.
-        # This is the key change to handle the floating-point year from Dialogflow.
-        dob_string = f"{int(patient_dob_obj.get('year'))}-{int(patient_dob_obj.get('month', 0)):02d}-{int(patient_dob_obj.get('day', 0)):02d}"
-
-        # Call the function to query the database.
-        response_text = verify_patient_insurance(
-            patient_policy_number,
-            patient_provider,
-            dob_string
-        )
-    
-    # Construct the final response in the format Dialogflow CX expects.
-    dialogflow_response = {
+    try:
+        next(get_db().collection('patients').limit(1).select([]).stream(timeout=FIRESTORE_TIMEOUT), None)
+        return "ok", 200
+    except Exception as e:
+        logger.error("Health check failed: %s", e)
+        return "err", 500
+
+# --- Response Text ---
+_VERIFIED_TEMPLATE = "Thank you. Your insurance with {p} and policy number {n} has been verified."
+_NOT_FOUND_TEXT = "We could not find a patient with the information you provided. Please check your details and try again."
+_DB_ERROR_TEXT = "Sorry, I am having trouble connecting to the database. Please try again later."
+_MISSING_PARAMS_TEXT = "Please provide your policy number, insurance provider, and date of birth to proceed with verification."
+
+# --- Dialogflow Request Formats ---
+# Dialogflow CX nests parameters inside 'sessionInfo' and expects a
+# 'fulfillmentResponse'; Dialogflow ES nests them inside 'queryResult' and
+# expects 'fulfillmentText'. Each format provides a parameter extractor that
+# returns (policy_number, provider, dob), with dob as 'YYYY-MM-DD' or None,
+# and a response builder.
+_Dialect = namedtuple('_Dialect', ['name', 'extract', 'respond'])
+
+def _cx_extract(req):
+    """Extracts the verification parameters from a Dialogflow CX request."""
+    params = req.session_info.parameters if req.session_info else Params()
+    return (
+        _param_text(params.policy_number),
+        _param_text(params.insurance_provider_name),
+        _dob_string(params.date_of_birth)
+    )
+
+def _cx_respond(response_text):
+    """Wraps the response text in the format Dialogflow CX expects."""
+    return {
         "fulfillmentResponse": {
             "messages": [
                 {
@@ -97,43 +394,245 @@ def webhook():
             ]
         }
     }
-    
+
+def _es_extract(req):
+    """Extracts the verification parameters from a Dialogflow ES request."""
+    params = req.query_result.parameters
+    return (
+        _param_text(params.policy_number) or _param_text(params.policyNumber),
+        _param_text(params.insurance_provider_name) or _param_text(params.insurance_provider),
+        _dob_string(params.date_of_birth)
+    )
+
+def _es_respond(response_text):
+    """Wraps the response text in the format Dialogflow ES expects."""
+    return {"fulfillmentText": response_text}
+
+_CX = _Dialect('cx', _cx_extract, _cx_respond)
+_ES = _Dialect('es', _es_extract, _es_respond)
+
+# The missing-parameters reply never changes, so serialize it once per format.
+_MISSING_PARAMS_JSON = {
+    dialect.name: orjson.dumps(dialect.respond(_MISSING_PARAMS_TEXT)) for dialect in (_CX, _ES)
+}
+
+def _dialect_for(req):
+    """Picks the request format; CX is assumed unless the request looks like ES."""
+    if req.session_info is None and req.query_result is not None:
+        return _ES
+    return _CX
+
+@app.route('/webhook', methods=['POST'])
+@app.route('/verify-insurance', methods=['POST'])
+def webhook():
+    """
+    Handles POST requests from Dialogflow CX or ES. It extracts patient information
+    from the request and verifies it against the Firestore 'patients' collection.
+    """
+    body = request.get_data()
+
+    # Log the full request JSON for debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook request: %s", body.decode(errors='replace'))
+
+    try:
+        req = _envelope_decoder.decode(body)
+    except msgspec.DecodeError as e:
+        abort(400, description=f"Invalid webhook request: {e}")
+
+    dialect = _dialect_for(req)
+    patient_policy_number, patient_provider, dob_string = dialect.extract(req)
+
+    logger.debug(
+        "Extracted %s parameters: policy_number=%s provider=%s dob=%s",
+        dialect.name, patient_policy_number, patient_provider, dob_string
+    )
+
+    # Check if all required parameters are available. Dialogflow only shows the
+    # fulfillment text on a 200, so the prompt is a 200 served from the
+    # pre-serialized body.
+    if not (patient_policy_number and patient_provider and dob_string):
+        return app.response_class(_MISSING_PARAMS_JSON[dialect.name], mimetype='application/json')
+
+    # Call the function to query the database.
+    response_text = verify_patient_insurance(
+        patient_policy_number,
+        patient_provider,
+        dob_string
+    )
+
+    dialogflow_response = dialect.respond(response_text)
+
     # Log the response JSON before sending it
-    logging.info("Final Dialogflow Response JSON:")
-    logging.info(json.dumps(dialogflow_response, indent=2))
-    logging.info("-----------------------------------")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook response: %s", orjson.dumps(dialogflow_response).decode())
 
     # Return the response to Dialogflow.
-    return jsonify(dialogflow_response)
+    return app.response_class(orjson.dumps(dialogflow_response), mimetype='application/json')
+
+# --- Cache Invalidation Endpoint ---
+# Matches the 'YYYY-MM-DD' strings produced by _dob_string.
+_DOB_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    Drops the cached verification result for a patient. Call this whenever a
+    patient record is created or updated. Requires the 'X-Admin-Token' header
+    to match the ADMIN_TOKEN environment variable; disabled if ADMIN_TOKEN is unset.
+
+    The body is JSON with the patient record's policyNumber, insuranceProvider
+    and dateOfBirth strings. dateOfBirth must be 'YYYY-MM-DD', the format the
+    webhook builds from Dialogflow dates, or it would not match a cached key.
+
+    Redis and this worker's in-process cache are cleared, and the policy number
+    is recorded as known so no worker's policy number filter rejects it. Other
+    workers' in-process caches expire after VERIFY_CACHE_TTL.
+    """
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), admin_token.encode()):
+        abort(403)
+
+    try:
+        body = orjson.loads(request.get_data())
+        key = (body['policyNumber'], body['insuranceProvider'], body['dateOfBirth'])
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        key = None
+    if key is None or not all(isinstance(v, str) and v for v in key) or not _DOB_RE.fullmatch(key[2]):
+        abort(400, description="Expected JSON with string policyNumber, insuranceProvider and dateOfBirth (YYYY-MM-DD).")
+
+    with _verify_cache_lock:
+        _verify_cache.pop(key, None)
+
+    r = get_redis()
+    if r is not None:
+        try:
+            with r.pipeline() as pipe:
+                pipe.delete(_redis_key(*key))
+                pipe.zadd(_BLOOM_ADDED_KEY, {key[0]: time.time()})
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.error("Redis invalidation failed: %s", e)
+            return "Sorry, the shared cache could not be cleared.", 503
+
+    return "", 204
 
 # --- Firestore Query Function ---
 def verify_patient_insurance(policy_number, provider, dob):
     """
     Queries the Firestore 'patients' collection to find a matching document.
+    Results are served from the in-process cache when available.
     """
+    if _policy_bloom_rejects(policy_number):
+        logger.info("Policy number not on file. Verification failed.")
+        return _NOT_FOUND_TEXT
+
+    key = (policy_number, provider, dob)
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+        if cached is None:
+            future = _verify_inflight.get(key)
+            leader = future is None
+            if leader:
+                future = _verify_inflight[key] = Future()
+
+    if cached is None:
+        try:
+            cached = _run_lookup(key, future) if leader else future.result()
+        except Exception as e:
+            logger.error("Database query failed: %s", e)
+            return _DB_ERROR_TEXT
+    else:
+        logger.debug("Verification cache hit.")
+
+    found, provider, policy_number = cached
+    if found:
+        return _VERIFIED_TEMPLATE.format(p=provider, n=policy_number)
+    return _NOT_FOUND_TEXT
+
+def _run_lookup(key, future):
+    """
+    Looks up a key on behalf of every request waiting on it, caches the
+    result and resolves the shared future.
+    """
+    policy_number, provider, dob = key
     try:
-        patients_ref = db.collection('patients')
-
-        # Build the compound query with all criteria.
-        query = patients_ref \
-            .where('policyNumber', '==', policy_number) \
-            .where('insuranceProvider', '==', provider) \
-            .where('dateOfBirth', '==', dob)
-
-        docs = query.stream()
-
-        # Check if any documents were found.
-        if any(docs):
-            logging.info("Database match found. Verification successful.")
-            return f"Thank you. Your insurance with {provider} and policy number {policy_number} has been verified."
-        else:
-            logging.info("No matching document found. Verification failed.")
-            return "We could not find a patient with the information you provided. Please check your details and try again."
+        cached = (_find_patient_shared(policy_number, provider, dob), provider, policy_number)
     except Exception as e:
-        logging.error(f"Database query failed: {e}")
-        return "Sorry, I am having trouble connecting to the database. Please try again later."
+        with _verify_cache_lock:
+            del _verify_inflight[key]
+        future.set_exception(e)
+        raise
+
+    with _verify_cache_lock:
+        _verify_cache[key] = cached
+        del _verify_inflight[key]
+    future.set_result(cached)
+    return cached
+
+def _find_patient_shared(policy_number, provider, dob):
+    """
+    Returns the verification result from Redis if present, otherwise queries
+    Firestore and stores the result in Redis.
+    """
+    r = get_redis()
+    if r is None:
+        return _find_patient(policy_number, provider, dob)
+
+    key = _redis_key(policy_number, provider, dob)
+    try:
+        hit = r.get(key)
+    except redis.RedisError as e:
+        logger.warning("Redis read failed: %s", e)
+        hit = None
+    if hit is not None:
+        logger.debug("Verification Redis hit.")
+        return hit == b"1"
+
+    found = _find_patient(policy_number, provider, dob)
+    try:
+        r.setex(key, VERIFY_CACHE_TTL, "1" if found else "0")
+    except redis.RedisError as e:
+        logger.warning("Redis write failed: %s", e)
+    return found
+
+def _lookup_key(policy_number, provider, dob):
+    """
+    Returns the value stored in each patient document's 'lookupKey' field.
+    It must be written alongside policyNumber, insuranceProvider and dateOfBirth
+    (see backfill_lookup_keys.py for existing documents).
+    """
+    return hashlib.sha256(f"{policy_number}|{provider}|{dob}".encode()).hexdigest()
+
+def _find_patient(policy_number, provider, dob):
+    """
+    Returns True if a document in the 'patients' collection matches all criteria.
+    """
+    patients_ref = get_db().collection('patients')
+
+    # A single equality on the precomputed key is served by the automatic
+    # single-field index. We only need to know that a match exists, so fetch
+    # at most one document and project no fields.
+    query = patients_ref \
+        .where('lookupKey', '==', _lookup_key(policy_number, provider, dob)) \
+        .limit(1) \
+        .select([])
+
+    # Pull only the first result from the stream; its presence is the answer.
+    hit = next(query.stream(timeout=FIRESTORE_TIMEOUT), None)
+
+    if hit is not None:
+        logger.info("Database match found. Verification successful.")
+        return True
+    logger.info("No matching document found. Verification failed.")
+    return False
 
 # --- Application Entry Point ---
-if __name__ == '__main__':
+# In production the app is served by Gunicorn (see gunicorn.conf.py).
+# Set FLASK_DEV=1 to run the Flask development server locally instead.
+if __name__ == '__main__' and os.environ.get('FLASK_DEV'):
+    start_policy_bloom_refresher()
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,567 @@
+# Tests for the verification path in main.py. Firestore and Redis are replaced
+# with in-memory fakes, so no credentials or network access are needed.
+
+import threading
+
+import orjson
+import pytest
+import redis
+
+import main
+
+
+class CountingStream:
+    """Iterator over canned documents that records how many were pulled."""
+
+    def __init__(self, docs, started=None, release=None):
+        self._docs = iter(docs)
+        self.pulled = 0
+        self._started = started
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._started is not None:
+            self._started.set()
+            self._release.wait(timeout=5)
+        self.pulled += 1
+        return next(self._docs)
+
+
+class FakeQuery:
+    def __init__(self, db):
+        self._db = db
+        self.filters = []
+
+    def where(self, field, op, value):
+        self.filters.append((field, op, value))
+        return self
+
+    def limit(self, count):
+        return self
+
+    def select(self, fields):
+        return self
+
+    def stream(self, timeout=None):
+        if not self.filters:
+            # Full scan of policy numbers for the Bloom filter.
+            return iter(FakeDoc(p) for p in self._db.policy_numbers)
+        self._db.queries.append(self.filters)
+        key = dict((f, v) for f, _, v in self.filters).get('lookupKey')
+        docs = ['doc', 'extra'] if key in self._db.keys else []
+        stream = CountingStream(docs, self._db.started, self._db.release)
+        self._db.streams.append(stream)
+        return stream
+
+
+class FakeDoc:
+    def __init__(self, policy_number):
+        self._data = {'policyNumber': policy_number}
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDb:
+    def __init__(self):
+        self.keys = set()
+        self.policy_numbers = []
+        self.queries = []
+        self.streams = []
+        self.started = None
+        self.release = None
+
+    def collection(self, name):
+        assert name == 'patients'
+        return FakeQuery(self)
+
+    def add_patient(self, policy_number, provider, dob):
+        self.keys.add(main._lookup_key(policy_number, provider, dob))
+        self.policy_numbers.append(policy_number)
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.data = {}
+        self.fail = fail
+
+    def _check(self):
+        if self.fail:
+            raise redis.ConnectionError("down")
+
+    def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        self._check()
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value).encode()
+        return True
+
+    def setex(self, key, ttl, value):
+        self.set(key, value)
+
+    def delete(self, key):
+        self._check()
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        self._check()
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    def hset(self, key, mapping):
+        self._check()
+        self.data.setdefault(key, {}).update(
+            (k, v if isinstance(v, bytes) else str(v).encode()) for k, v in mapping.items()
+        )
+
+    def hmget(self, key, fields):
+        self._check()
+        h = self.data.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def zadd(self, key, mapping):
+        self._check()
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zscore(self, key, member):
+        self._check()
+        return self.data.get(key, {}).get(member)
+
+    def zremrangebyscore(self, key, low, high):
+        self._check()
+        z = self.data.get(key, {})
+        for member in [m for m, score in z.items() if score <= high]:
+            del z[member]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Buffers commands until execute(); after watch() runs them immediately until multi()."""
+
+    def __init__(self, r):
+        self._r = r
+        self._buffered = True
+        self._commands = []
+        self._watched = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def watch(self, key):
+        self._watched = (key, self._r.data.get(key))
+        self._buffered = False
+
+    def multi(self):
+        self._buffered = True
+
+    def __getattr__(self, name):
+        method = getattr(self._r, name)
+        if not self._buffered:
+            return method
+        return lambda *args, **kwargs: self._commands.append((method, args, kwargs))
+
+    def execute(self):
+        if self._watched and self._r.data.get(self._watched[0]) != self._watched[1]:
+            raise redis.WatchError()
+        return [method(*args, **kwargs) for method, args, kwargs in self._commands]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(main, 'get_db', lambda: fake)
+    monkeypatch.setattr(main, 'get_redis', lambda: None)
+    monkeypatch.setattr(main, '_policy_bloom', None)
+    main._verify_cache.clear()
+    main._verify_inflight.clear()
+    yield fake
+    main._verify_cache.clear()
+    main._verify_inflight.clear()
+
+
+def test_find_patient_reads_only_first_document(db):
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+
+    assert main._find_patient('A1', 'Aetna', '1990-03-07') is True
+    assert [s.pulled for s in db.streams] == [1]
+    assert db.queries == [[('lookupKey', '==', main._lookup_key('A1', 'Aetna', '1990-03-07'))]]
+
+
+def test_find_patient_miss(db):
+    assert main._find_patient('A1', 'Aetna', '1990-03-07') is False
+    assert len(db.streams) == 1
+
+
+def test_verify_uses_cache_on_repeat(db):
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+
+    first = main.verify_patient_insurance('A1', 'Aetna', '1990-03-07')
+    second = main.verify_patient_insurance('A1', 'Aetna', '1990-03-07')
+
+    assert first == second == main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')
+    assert len(db.queries) == 1
+
+
+def test_verify_does_not_cache_errors(db, monkeypatch):
+    calls = []
+
+    def broken(*args):
+        calls.append(args)
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(main, '_find_patient', broken)
+
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._DB_ERROR_TEXT
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._DB_ERROR_TEXT
+    assert len(calls) == 2
+    assert not main._verify_inflight
+
+
+def test_concurrent_identical_lookups_share_one_query(db, monkeypatch):
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+    db.started = threading.Event()
+    db.release = threading.Event()
+    waiting = threading.Semaphore(0)
+
+    class TrackedFuture(main.Future):
+        def result(self, timeout=None):
+            waiting.release()
+            return super().result(timeout)
+
+    monkeypatch.setattr(main, 'Future', TrackedFuture)
+    results = []
+
+    def verify():
+        results.append(main.verify_patient_insurance('A1', 'Aetna', '1990-03-07'))
+
+    leader = threading.Thread(target=verify)
+    leader.start()
+    assert db.started.wait(timeout=5)
+    followers = [threading.Thread(target=verify) for _ in range(4)]
+    for t in followers:
+        t.start()
+    # Release the leader's query only once every follower is waiting on it.
+    for _ in followers:
+        assert waiting.acquire(timeout=5)
+    db.release.set()
+    for t in [leader] + followers:
+        t.join(timeout=5)
+
+    assert len(db.queries) == 1
+    assert results == [main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')] * 5
+    assert not main._verify_inflight
+
+
+def test_redis_hit_skips_firestore(db, monkeypatch):
+    r = FakeRedis()
+    r.data[main._redis_key('A1', 'Aetna', '1990-03-07')] = b"1"
+    monkeypatch.setattr(main, 'get_redis', lambda: r)
+
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')
+    assert db.queries == []
+
+
+def test_redis_miss_stores_result(db, monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(main, 'get_redis', lambda: r)
+
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._NOT_FOUND_TEXT
+    assert r.data == {main._redis_key('A1', 'Aetna', '1990-03-07'): b"0"}
+
+
+def test_redis_failure_falls_back_to_firestore(db, monkeypatch):
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+    monkeypatch.setattr(main, 'get_redis', lambda: FakeRedis(fail=True))
+
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')
+    assert len(db.queries) == 1
+
+
+# --- Webhook ---
+
+@pytest.fixture
+def client(db):
+    return main.app.test_client()
+
+
+def test_cx_webhook_verifies(client, db):
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+    resp = client.post('/webhook', json={
+        "detectIntentResponseId": "abc",
+        "sessionInfo": {
+            "session": "projects/p/locations/l/agents/a/sessions/s",
+            "parameters": {
+                "policy_number": "A1",
+                "insurance_provider_name": "Aetna",
+                "date_of_birth": {"year": 1990.0, "month": 3.0, "day": 7.0}
+            }
+        },
+        "fulfillmentInfo": {"tag": "verify"}
+    })
+
+    assert resp.status_code == 200
+    assert resp.get_json() == main._cx_respond(main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1'))
+
+
+def test_es_webhook_verifies_iso_date(client, db):
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+    resp = client.post('/verify-insurance', json={
+        "responseId": "response-id",
+        "session": "projects/p/agent/sessions/s",
+        "queryResult": {
+            "queryText": "March 7th 1990",
+            "parameters": {
+                "policy_number": "A1",
+                "insurance_provider_name": "Aetna",
+                "date_of_birth": "1990-03-07T12:00:00+00:00"
+            },
+            "allRequiredParamsPresent": True,
+            "intent": {"name": "projects/p/agent/intents/i", "displayName": "Verify Insurance"},
+            "intentDetectionConfidence": 1,
+            "languageCode": "en"
+        },
+        "originalDetectIntentRequest": {"payload": {}}
+    })
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {"fulfillmentText": main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')}
+
+
+def test_webhook_rejects_malformed_json(client):
+    resp = client.post('/webhook', data=b'not json')
+    assert resp.status_code == 400
+
+
+def _cx_request(**params):
+    return {"sessionInfo": {"parameters": params}}
+
+
+def _missing_params(dialect):
+    return orjson.loads(main._MISSING_PARAMS_JSON[dialect])
+
+
+@pytest.mark.parametrize('params', [
+    {"policy_number": None, "insurance_provider_name": "Aetna",
+     "date_of_birth": {"year": 1990.0, "month": 3.0, "day": 7.0}},
+    {"policy_number": "A1", "insurance_provider_name": "Aetna", "date_of_birth": {}},
+    {"policy_number": "A1", "insurance_provider_name": "Aetna", "date_of_birth": {"year": 1990.0}},
+    {"policy_number": "A1", "insurance_provider_name": "Aetna",
+     "date_of_birth": {"year": 1990.0, "month": 2.0, "day": 30.0}},
+    {"policy_number": "A1", "insurance_provider_name": "Aetna",
+     "date_of_birth": {"year": 1e30, "month": 3, "day": 7}},
+    {"policy_number": "  ", "insurance_provider_name": "Aetna",
+     "date_of_birth": {"year": 1990.0, "month": 3.0, "day": 7.0}},
+    {"insurance_provider_name": "Aetna", "date_of_birth": None},
+    {},
+])
+def test_cx_missing_or_partial_params_prompt(client, db, params):
+    resp = client.post('/webhook', json=_cx_request(**params))
+
+    assert resp.status_code == 200
+    assert resp.get_json() == _missing_params('cx')
+    assert db.queries == []
+
+
+def test_cx_numeric_policy_number_is_looked_up(client, db):
+    db.add_patient('12345', 'Aetna', '1990-03-07')
+    resp = client.post('/webhook', json=_cx_request(
+        policy_number=12345.0,
+        insurance_provider_name="Aetna",
+        date_of_birth={"year": 1990.0, "month": 3.0, "day": 7.0}
+    ))
+
+    assert resp.status_code == 200
+    assert resp.get_json() == main._cx_respond(main._VERIFIED_TEMPLATE.format(p='Aetna', n='12345'))
+
+
+def test_es_unfilled_params_prompt(client, db):
+    resp = client.post('/webhook', json={"queryResult": {"parameters": {
+        "policy_number": "A1", "insurance_provider_name": "Aetna", "date_of_birth": ""
+    }}})
+
+    assert resp.status_code == 200
+    assert resp.get_json() == _missing_params('es')
+    assert db.queries == []
+
+
+# --- Policy number filter ---
+
+def test_fresh_bloom_rejects_unknown_policy(db, monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(main, 'get_redis', lambda: r)
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+
+    main._sync_policy_bloom(r)
+
+    assert main._policy_bloom is not None
+    assert main.verify_patient_insurance('ZZ', 'Aetna', '1990-03-07') == main._NOT_FOUND_TEXT
+    assert db.queries == []
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')
+    assert len(db.queries) == 1
+
+
+def test_stale_bloom_does_not_reject(db, monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(main, 'get_redis', lambda: r)
+    main._sync_policy_bloom(r)
+    bloom = main._policy_bloom
+    monkeypatch.setattr(main, '_policy_bloom', bloom._replace(built_at=bloom.built_at - main.POLICY_BLOOM_MAX_AGE_SECONDS - 1))
+    db.add_patient('A1', 'Aetna', '1990-03-07')
+
+    assert main.verify_patient_insurance('A1', 'Aetna', '1990-03-07') == main._VERIFIED_TEMPLATE.format(p='Aetna', n='A1')
+    assert len(db.queries) == 1
+
+
+def test_bloom_is_loaded_not_rebuilt_by_other_workers(db, monkeypatch):
+    r = FakeRedis()
+    main._sync_policy_bloom(r)
+    built_at = main._policy_bloom.built_at
+
+    builds = []
+    monkeypatch.setattr(main, '_build_policy_bloom', lambda: builds.append(1))
+    monkeypatch.setattr(main, '_policy_bloom', None)
+    main._sync_policy_bloom(r)
+
+    assert builds == []
+    assert main._policy_bloom.built_at == built_at
+
+
+def test_invalidated_policy_is_not_rejected_by_existing_filters(db, monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(main, 'get_redis', lambda: r)
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    main._sync_policy_bloom(r)
+    assert main._policy_bloom_rejects('B2')
+
+    db.add_patient('B2', 'Aetna', '1990-03-07')
+    resp = main.app.test_client().post(
+        '/cache/invalidate',
+        json={'policyNumber': 'B2', 'insuranceProvider': 'Aetna', 'dateOfBirth': '1990-03-07'},
+        headers={'X-Admin-Token': 'secret'}
+    )
+    assert resp.status_code == 204
+
+    # The shared filter is kept; the recorded policy number overrides it.
+    assert main._policy_bloom is not None
+    assert not main._policy_bloom_rejects('B2')
+    assert main.verify_patient_insurance('B2', 'Aetna', '1990-03-07') == main._VERIFIED_TEMPLATE.format(p='Aetna', n='B2')
+
+
+def test_rebuild_prunes_policies_it_covers(db, monkeypatch):
+    r = FakeRedis()
+    now = main.time.time()
+    r.zadd(main._BLOOM_ADDED_KEY, {'OLD': now - main._POLICY_BLOOM_ADDED_MARGIN - 10, 'NEW': now})
+
+    main._publish_policy_bloom(r)
+
+    assert set(r.data[main._BLOOM_ADDED_KEY]) == {'NEW'}
+    assert main._BLOOM_LOCK_KEY not in r.data
+
+
+def test_failed_rebuild_backs_off(db, monkeypatch):
+    r = FakeRedis()
+    builds = []
+
+    def failing_build():
+        builds.append(1)
+        raise RuntimeError("deadline exceeded")
+
+    monkeypatch.setattr(main, '_build_policy_bloom', failing_build)
+    main._sync_policy_bloom(r)
+    main._sync_policy_bloom(r)
+
+    assert builds == [1]
+    assert r.data[main._BLOOM_FAILURES_KEY] == b'1'
+    assert main._BLOOM_BACKOFF_KEY in r.data
+    assert main._BLOOM_LOCK_KEY not in r.data
+    assert main._policy_bloom is None
+
+
+def test_rebuild_keeps_a_lock_taken_over_by_another_worker(db, monkeypatch):
+    r = FakeRedis()
+    real_build = main._build_policy_bloom
+
+    def slow_build():
+        # Our lock expired mid-scan and another worker acquired it.
+        r.data[main._BLOOM_LOCK_KEY] = b'other-worker'
+        return real_build()
+
+    monkeypatch.setattr(main, '_build_policy_bloom', slow_build)
+    main._publish_policy_bloom(r)
+
+    assert r.data[main._BLOOM_LOCK_KEY] == b'other-worker'
+    assert main._BLOOM_KEY in r.data
+
+
+def test_bloom_rejection_falls_through_when_redis_fails(db, monkeypatch):
+    r = FakeRedis()
+    main._sync_policy_bloom(r)
+    monkeypatch.setattr(main, 'get_redis', lambda: FakeRedis(fail=True))
+
+    assert not main._policy_bloom_rejects('ZZ')
+
+
+def test_refresher_warns_when_refresh_exceeds_max_age(db, monkeypatch, caplog):
+    monkeypatch.setattr(main, 'get_redis', lambda: FakeRedis())
+    monkeypatch.setattr(main, 'POLICY_BLOOM_REFRESH_SECONDS', 10_000)
+    monkeypatch.setattr(main, 'POLICY_BLOOM_MAX_AGE_SECONDS', 7200)
+    monkeypatch.setattr(main, '_policy_bloom_thread', object())
+
+    main.start_policy_bloom_refresher()
+
+    assert 'exceeds POLICY_BLOOM_MAX_AGE_SECONDS' in caplog.text
+
+
+def test_invalidate_rejects_non_string_fields(db, monkeypatch):
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    resp = main.app.test_client().post(
+        '/cache/invalidate',
+        json={'policyNumber': ['x'], 'insuranceProvider': 'Aetna', 'dateOfBirth': '1990-03-07'},
+        headers={'X-Admin-Token': 'secret'}
+    )
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('token', ['wrong', 'sécret'])
+def test_invalidate_rejects_bad_token(db, monkeypatch, token):
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    resp = main.app.test_client().post(
+        '/cache/invalidate',
+        json={'policyNumber': 'A1', 'insuranceProvider': 'Aetna', 'dateOfBirth': '1990-03-07'},
+        headers={'X-Admin-Token': token}
+    )
+    assert resp.status_code == 403
+
+
+def test_credential_refresh_has_deadline(monkeypatch):
+    captured = []
+
+    class FakeCredential:
+        valid = False
+
+        def refresh(self, request):
+            captured.append(request)
+
+    class FakeApp:
+        class credential:
+            @staticmethod
+            def get_credential():
+                return FakeCredential()
+
+    monkeypatch.setattr(main.firebase_admin, 'get_app', lambda: FakeApp)
+    main._warm_credentials()
+
+    assert captured[0].keywords == {'timeout': main.FIRESTORE_TIMEOUT}